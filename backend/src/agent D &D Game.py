@@ -1,10 +1,20 @@
 import os
+import contextlib
+import re
 import logging
+import logging.handlers
+import atexit
 import asyncio
+import concurrent.futures
+import contextvars
 import json
-from datetime import datetime
+import operator
+import queue
+import threading
+import time
+import weakref
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Any, Callable, Dict, List
 
 from dotenv import load_dotenv
 
@@ -26,9 +36,150 @@ from livekit.plugins.turn_detector.multilingual import MultilingualModel
 load_dotenv(".env.local")
 logger = logging.getLogger("demon.slayer.gm.agent")
 
+
+class _RootForwarder(logging.Handler):
+    """Hands queued records to whatever handlers the root logger has at emit time.
+
+    LiveKit's CLI configures root logging after this module is imported, so the
+    target handlers are looked up per record rather than captured up front.
+    """
+    def handle(self, record: logging.LogRecord) -> bool:
+        logging.getLogger().callHandlers(record)
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records untouched, so formatting (and exc_info) is left to the listener."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# --- Async Logging ---
+# Records are queued as-is on the caller's thread; the background listener
+# formats and writes them, keeping both off the tool-call path.
+_LOG_Q: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+logger.addHandler(_DeferredQueueHandler(_LOG_Q))
+logger.propagate = False
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_Q, _RootForwarder())
+_LOG_LISTENER.start()
+
 # --- Configuration for Saving Files ---
 SAVE_DIR = Path(__file__).parent.joinpath('game_saves')
 SAVE_DIR.mkdir(exist_ok=True) # Ensure the directory exists
+_SAVE_DIR_STR = str(SAVE_DIR)  # Plain string for building filenames on the save path
+
+# --- Player name extraction patterns (case-insensitive, compiled once) ---
+# [^\W\d_] is any Unicode letter, so names like "José" or "Zoë" survive intact.
+_NAME_RE = re.compile(r'my name is\s+([^\W\d_]+(?:[^\S\n]+[^\W\d_]+)*)', re.I)
+_SOLO_RE = re.compile(r'^\s*([^\W\d_]+)(?:\s+\S+){0,2}\s*$')
+
+_get_role_content = operator.attrgetter('role', 'content')
+
+
+def _content_text(content: Any) -> str:
+    """Normalizes message content to plain text.
+
+    LiveKit ChatMessage.content is a list of parts (text, images, audio);
+    only the text parts are kept, joined with spaces.
+    """
+    if content is None:
+        return ''
+    if isinstance(content, str):
+        return content
+    return " ".join(part for part in content if isinstance(part, str))
+
+SAVE_BUFFER_SIZE = 1 << 16  # 64 KiB, coalesces the per-entry writes below
+VERBATIM_TURNS = 6  # Most recent turns kept word-for-word in a save
+SUMMARY_SNIPPET_CHARS = 80  # Per-turn excerpt length in the collapsed summary
+_TS_FMT = "%Y%m%d_%H%M%S"
+
+
+def _encode_json(obj: Any) -> bytes:
+    """Compact UTF-8 JSON encoding for one save-file fragment."""
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _write_save(filename: str, save_data: Dict[str, Any]) -> None:
+    """Streams a save file to disk one history entry at a time, atomically.
+
+    The history list itself is already in memory; what this avoids is a
+    second, full-size encoded copy of it. Only the metadata header and one
+    message are encoded at a time before going through the write buffer.
+    """
+    meta = {k: v for k, v in save_data.items() if k != "history"}
+    # Write to a temp file and rename it into place so a crash mid-write
+    # never leaves a torn save behind.
+    tmp = f"{filename}.tmp"
+    try:
+        with open(tmp, 'wb', buffering=SAVE_BUFFER_SIZE) as f:
+            # Reopen the metadata object to append the history array to it.
+            f.write(_encode_json(meta)[:-1])
+            f.write(b',"history":[' if meta else b'"history":[')
+            for i, msg in enumerate(save_data["history"]):
+                if i:
+                    f.write(b',')
+                f.write(_encode_json(msg))
+            f.write(b']}')
+            # Make the data durable before the rename can be, or a power
+            # loss could leave an empty file under the final name.
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+# --- Background Save Writer ---
+# One long-lived daemon thread runs every save job: flattening, encoding and
+# disk I/O. Callers only enqueue, and each job's Future resolves to the
+# player-facing result message.
+_SAVE_Q: "queue.Queue[tuple[Callable[..., str], tuple, concurrent.futures.Future]]" = queue.Queue()
+
+
+def _writer_loop() -> None:
+    while True:
+        job, args, future = _SAVE_Q.get()
+        try:
+            # Queued saves always run, even if whoever was waiting on the
+            # Future gave up; only the result is then discarded.
+            future.set_running_or_notify_cancel()
+            try:
+                result = job(*args)
+            except Exception as e:
+                logger.exception("Error saving game state: %s", e)
+                result = f"❌ Error saving game state: {e}"
+            if not future.cancelled():
+                future.set_result(result)
+        finally:
+            _SAVE_Q.task_done()
+
+
+def _queue_save(job: Callable[..., str], *args: Any) -> "concurrent.futures.Future[str]":
+    """Hands a save job to the writer thread; the Future yields its result message."""
+    future: "concurrent.futures.Future[str]" = concurrent.futures.Future()
+    _SAVE_Q.put_nowait((job, args, future))
+    return future
+
+
+threading.Thread(target=_writer_loop, name="game-save-writer", daemon=True).start()
+
+
+def _shutdown() -> None:
+    # The writer is a daemon thread: let queued saves finish first, then stop
+    # the log listener so the writer's final records are still delivered.
+    _SAVE_Q.join()
+    _LOG_LISTENER.stop()
+
+
+atexit.register(_shutdown)
+
+
+# --- Tool Response Strings ---
+_RESTART_MSG = "The chamber resets, the door seals once more. Your second attempt begins now!"
+_NO_SAVE_MSG = "Could not save previous session. " + _RESTART_MSG
+
 
 # --- Day 8: Game Master Logic Class (Updated with Save Logic) ---
 
@@ -38,53 +189,131 @@ class GameMasterLogic:
     Note: For the Escape Room, player_name extraction might be less relevant, but the save logic remains.
     """
     def __init__(self):
+        # session -> (turns already scanned, name found so far), so repeated saves
+        # in one session only look at new turns. Weak keys drop ended sessions.
+        self._name_cache: "weakref.WeakKeyDictionary[Any, tuple]" = weakref.WeakKeyDictionary()
         logger.info("Game Master Logic initialized for The Whispering Library. Save directory: %s", SAVE_DIR)
 
-    def _get_player_info(self, chat_history: List[Dict[str, Any]]) -> str:
-        """Attempts to extract the player's name from the first user message, or uses a default."""
+    def _get_player_info(self, chat_history: List[Dict[str, Any]], session: Any = None) -> str:
+        """Attempts to extract the player's name from the first user message, or uses a default.
+
+        With a session, the result is cached per session; without one the
+        whole history is scanned every time.
+        """
+        scanned, name = 0, None
+        if session is not None:
+            try:
+                scanned, name = self._name_cache.get(session, (0, None))
+            except TypeError:
+                # Not weak-referenceable, so it can't be cached.
+                session = None
+            if scanned > len(chat_history):
+                # The session's history was truncated; start over.
+                scanned, name = 0, None
+        if name is None:
+            for msg in chat_history[scanned:]:
+                if msg.get('role') == 'user':
+                    content = _content_text(msg.get('content'))
+                    m = _NAME_RE.search(content)
+                    if m is None:
+                        # If the user says something simple like "Lysandra" at the start
+                        m = _SOLO_RE.match(content)
+                    if m is not None:
+                        name = m.group(1).title()
+                        break
+            if session is not None:
+                self._name_cache[session] = (len(chat_history), name)
+        return name or "Lysandra_the_Adventurer" # Default name for The Whispering Library
+
+    def _flatten_history(self, history) -> List[Dict[str, Any]]:
+        """Converts chat items into plain role/text-content dicts for serialization.
+
+        Non-message items in a ChatContext (function calls and their outputs)
+        are skipped; plain dicts are accepted as already flattened.
+        """
+        flat = []
+        for item in history or ():
+            if isinstance(item, dict):
+                role, content = item.get('role'), item.get('content')
+            elif getattr(item, 'type', 'message') != 'message':
+                continue
+            else:
+                role, content = _get_role_content(item)
+            flat.append({'role': role, 'content': _content_text(content)})
+        return flat
+
+    def _dedupe_history(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Merges runs of identical consecutive messages into one entry with a repeat count 'n'."""
+        deduped: List[Dict[str, Any]] = []
+        prev = None
         for msg in chat_history:
-            if msg.get('role') == 'user':
-                content = msg.get('content', '').lower()
-                if 'my name is' in content:
-                    name_part = content.split('my name is', 1)[1].split(',')[0].strip()
-                    return name_part.title()
-                # If the user says something simple like "Lysandra" at the start
-                parts = content.split()
-                if parts and len(parts) <= 3 and parts[0].isalpha():
-                    return parts[0].title()
-        return "Lysandra_the_Adventurer" # Default name for The Whispering Library
-
-    def save_game_state(self, chat_history: List[Dict[str, Any]]) -> str:
-        """Accesses the full chat history and saves it to a JSON file."""
+            key = (msg.get('role'), msg.get('content'))
+            if key == prev:
+                last = deduped[-1]
+                last['n'] = last.get('n', 1) + 1
+            else:
+                deduped.append({'role': key[0], 'content': key[1]})
+                prev = key
+        return deduped
+
+    def _collapse_history(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Keeps the last VERBATIM_TURNS turns and folds older ones into one summary entry."""
+        older = chat_history[:-VERBATIM_TURNS]
+        lines = []
+        for msg in older:
+            content = _content_text(msg.get('content'))
+            repeat = f" (x{msg['n']})" if msg.get('n', 1) > 1 else ""
+            lines.append(f"{msg.get('role')}{repeat}: {content[:SUMMARY_SNIPPET_CHARS]}")
+        summary = {'role': 'summary', 'content': "\n".join(lines)}
+        return [summary, *chat_history[-VERBATIM_TURNS:]]
+
+    def save_game_state(self, history, session: Any = None) -> str:
+        """Accesses the full chat history and saves it to a JSON file.
+
+        Runs on the save writer thread, so flattening and encoding the messages
+        stay off the event loop. `session` (the caller's AgentSession) scopes
+        the player-name cache.
+        """
+        chat_history = self._flatten_history(history)
         if not chat_history:
             return "❌ Cannot save: The chat history is empty."
 
-        player_name = self._get_player_info(chat_history)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        player_name = self._get_player_info(chat_history, session)
+        timestamp = time.strftime(_TS_FMT)
         
+        # Streaming STT/LLM can repeat a frame; store each run only once.
+        deduped = self._dedupe_history(chat_history)
+
         # Update the game name
         save_data = {
             "game": "The Whispering Library Escape",
             "player_name": player_name,
             "save_time": timestamp,
             "turns_count": len(chat_history),
-            "history": chat_history
+            "collapsed_turns": 0,
+            "history": deduped
         }
+        # Older turns only need their gist; keep the recent tail verbatim.
+        # Both counts are raw turns, so repeats folded into an entry count too.
+        if len(deduped) > VERBATIM_TURNS:
+            collapsed = deduped[:-VERBATIM_TURNS]
+            save_data["collapsed_turns"] = sum(msg.get('n', 1) for msg in collapsed)
+            save_data["history"] = self._collapse_history(deduped)
 
-        filename = SAVE_DIR.joinpath(f"{player_name}_{timestamp}.json")
+        basename = f"{player_name}_{timestamp}.json"
+        filename = f"{_SAVE_DIR_STR}/{basename}"
         
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(save_data, f, indent=4)
+            _write_save(filename, save_data)
             logger.info("Game state saved to: %s", filename)
-            return f"✅ Game state saved successfully as {filename.name}."
+            return f"✅ Game state saved successfully as {basename}."
         except Exception as e:
             logger.error("Error saving game state: %s", e)
             return f"❌ Error saving game state: {e}"
 
     def restart_adventure(self) -> str:
         """The command to trigger the next session (after saving)."""
-        return "The chamber resets, the door seals once more. Your second attempt begins now!"
+        return _RESTART_MSG
 
 
 # --- Initialize Logic Instance and Tool Function ---
@@ -98,26 +327,30 @@ async def restart_tool(ctx: RunContext) -> str:
     and then signals the LLM to start a new game.
     """
     
-    if hasattr(ctx, 'history') and ctx.history:
-        try:
-            chat_history = [{'role': m.role, 'content': m.content} for m in ctx.history]
-        except AttributeError:
-            chat_history = ctx.history
+    # RunContext has no history of its own; the transcript lives on the
+    # session's ChatContext.
+    session = getattr(ctx, 'session', None)
+    chat_ctx = getattr(session, 'history', None)
+    items = getattr(chat_ctx, 'items', None)
+    if not items:
+        # Nothing to save, so don't bother the writer thread.
+        return _NO_SAVE_MSG
 
-        save_message = await asyncio.to_thread(GM_LOGIC.save_game_state, chat_history)
-        
-        # The tool returns the save message and the restart signal.
-        return save_message + " " + GM_LOGIC.restart_adventure()
-    
-    return "Could not save previous session. " + GM_LOGIC.restart_adventure()
+    # Only a shallow copy of the item list and the enqueue happen on the
+    # event loop; the writer thread does the rest. The copy keeps the writer
+    # from iterating the list while the session appends turns. Shield the
+    # wait so a barge-in cancelling this tool call doesn't cancel the save.
+    save_future = _queue_save(GM_LOGIC.save_game_state, list(items), session)
+    save_message = await asyncio.shield(asyncio.wrap_future(save_future))
+
+    # The tool returns the save message and the restart signal.
+    return f"{save_message} {_RESTART_MSG}"
 
 
 # --- The LiveKit Assistant Class (The Persona) ---
 
-class Assistant(Agent):
-    def __init__(self) -> None:
-        super().__init__(
-            instructions="""You are the **Game Master (GM)** for an interactive, single-player, voice-only adventure game called **The Whispering Library**. Your role is to guide the player (Lysandra, a clever adventurer) through a magical escape room puzzle.
+# Defined once at import and shared by every Assistant instance.
+_INSTRUCTIONS = """You are the **Game Master (GM)** for an interactive, single-player, voice-only adventure game called **The Whispering Library**. Your role is to guide the player (Lysandra, a clever adventurer) through a magical escape room puzzle.
 
             **Universe & Tone:** You narrate a low-fantasy, suspenseful escape scenario inside an ancient, sorcerer's archive. The tone is mysterious and challenging. The goal is to escape the room by solving a riddle and unlocking mechanisms.
 
@@ -144,22 +377,56 @@ class Assistant(Agent):
             * **(D)** Search the floor around the desk for the source of the slithering sound.
 
             **Which option (A, B, C, or D) do you choose?**
-            """,
+            """
+
+
+class Assistant(Agent):
+    def __init__(self) -> None:
+        super().__init__(
+            instructions=_INSTRUCTIONS,
             tools=[restart_tool]
         )
 
 def prewarm(proc: JobProcess):
     proc.userdata["vad"] = silero.VAD.load()
 
+def _run_in_thread(loop: asyncio.AbstractEventLoop, fn) -> asyncio.Future:
+    """Submits fn to the default executor immediately, carrying over contextvars."""
+    return loop.run_in_executor(None, contextvars.copy_context().run, fn)
+
 async def entrypoint(ctx: JobContext):
-    # Initialize the LLM, STT, and TTS components
-    session = AgentSession(
-        stt=deepgram.STT(model="nova-3"),
-        llm=google.LLM(model="gemini-2.5-flash", api_key=os.getenv("GOOGLE_API_KEY")),
+    # Submit the model loads to worker threads right away so they run while the
+    # clients below are built (a Task would not start until the next await).
+    loop = asyncio.get_running_loop()
+    prewarmed_vad = ctx.proc.userdata.get("vad")
+    if prewarmed_vad is None:
+        vad_future = _run_in_thread(loop, silero.VAD.load)
+    else:
+        vad_future = loop.create_future()
+        vad_future.set_result(prewarmed_vad)
+    td_future = _run_in_thread(loop, MultilingualModel)
+
+    try:
+        # Initialize the LLM, STT, and TTS components
+        stt = deepgram.STT(model="nova-3")
+        llm = google.LLM(model="gemini-2.5-flash", api_key=os.getenv("GOOGLE_API_KEY"))
         # I've updated the TTS style to be appropriate for a suspenseful fantasy scenario
-        tts=murf.TTS(voice="en-US-matthew", style="Tense", text_pacing=True), 
-        turn_detection=MultilingualModel(),
-        vad=ctx.proc.userdata["vad"],
+        tts = murf.TTS(voice="en-US-matthew", style="Tense", text_pacing=True)
+    except BaseException:
+        # Don't leave the model loads pending (or their errors unretrieved).
+        for future in (vad_future, td_future):
+            future.cancel()
+        await asyncio.gather(vad_future, td_future, return_exceptions=True)
+        raise
+
+    vad, turn_detection = await asyncio.gather(vad_future, td_future)
+
+    session = AgentSession(
+        stt=stt,
+        llm=llm,
+        tts=tts,
+        turn_detection=turn_detection,
+        vad=vad,
         preemptive_generation=True,
     )
 
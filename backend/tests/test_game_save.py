@@ -0,0 +1,258 @@
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# The Game Master agent lives in a file whose name isn't importable, so load it by path.
+_GAME_PATH = Path(__file__).resolve().parents[1] / "src" / "agent D &D Game.py"
+
+
+@pytest.fixture(scope="module")
+def game():
+    spec = importlib.util.spec_from_file_location("dnd_game_agent", _GAME_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def gm(game):
+    return game.GameMasterLogic()
+
+
+def _turns(n: int) -> list:
+    return [{"role": "assistant", "content": f"turn {i}"} for i in range(n)]
+
+
+class _Session:
+    """Weak-referenceable stand-in for an AgentSession and its ChatContext."""
+
+    def __init__(self, items=None) -> None:
+        self.history = SimpleNamespace(items=items or [])
+
+
+def _message(role: str, *content) -> SimpleNamespace:
+    """Mimics a LiveKit ChatMessage, whose content is a list of parts."""
+    return SimpleNamespace(type="message", role=role, content=list(content))
+
+
+def _user(content: str) -> dict:
+    return {"role": "user", "content": content}
+
+
+def _save(game, gm, history, tmp_path, monkeypatch) -> dict:
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path))
+    message = gm.save_game_state(history)
+    assert message.startswith("✅"), message
+    (saved,) = tmp_path.glob("*.json")
+    return json.loads(saved.read_text(encoding="utf-8"))
+
+
+def test_flatten_history(gm) -> None:
+    """Message objects become role/content dicts; dicts and None pass through."""
+    messages = [SimpleNamespace(role="user", content="hi", extra=1)]
+    assert gm._flatten_history(messages) == [{"role": "user", "content": "hi"}]
+    assert gm._flatten_history([_message("user", "a", "b")]) == [{"role": "user", "content": "a b"}]
+    assert gm._flatten_history([{"role": "user", "content": "hi"}]) == [
+        {"role": "user", "content": "hi"}
+    ]
+    assert gm._flatten_history(None) == []
+
+
+@pytest.mark.parametrize(
+    ("content", "expected"),
+    [
+        ("my name is José, hi", "José"),
+        ("My name is Mary Jane, hello", "Mary Jane"),
+        ("Zoë", "Zoë"),
+        ("Option A please", "Option"),
+        # Legacy split() kept the slashes and made them part of the save path.
+        ("my name is bob/../x", "Bob"),
+    ],
+)
+def test_player_name_extraction(gm, content: str, expected: str) -> None:
+    assert gm._get_player_info([{"role": "user", "content": content}]) == expected
+
+
+def test_player_name_requires_whole_phrase(gm) -> None:
+    """'my name isabel' is not a 'my name is' introduction."""
+    history = [{"role": "user", "content": "my name isabel and I like books"}]
+    assert gm._get_player_info(history) == "Lysandra_the_Adventurer"
+
+
+def test_player_name_cache_is_per_session(gm) -> None:
+    alice, bob = _Session(), _Session()
+    assert gm._get_player_info([_user("my name is Alice")], alice) == "Alice"
+    bob_history = [_user("my name is Bob"), *_turns(2)]
+    assert gm._get_player_info(bob_history, bob) == "Bob"
+    assert gm._get_player_info([_user("my name is Alice"), *_turns(3)], alice) == "Alice"
+
+
+def test_player_name_cache_resets_on_truncated_history(gm) -> None:
+    session = _Session()
+    assert gm._get_player_info(_turns(3), session) == "Lysandra_the_Adventurer"
+    assert gm._get_player_info([_user("my name is Carol")], session) == "Carol"
+
+
+def test_player_name_found_in_later_turns(gm) -> None:
+    session = _Session()
+    history = [*_turns(1), _user("I open the big door slowly")]
+    assert gm._get_player_info(history, session) == "Lysandra_the_Adventurer"
+    history.append(_user("my name is Dana"))
+    assert gm._get_player_info(history, session) == "Dana"
+
+
+def test_dedupe_merges_consecutive_runs_only(gm) -> None:
+    """Back-to-back duplicates collapse into one entry with a repeat count."""
+    a = {"role": "user", "content": "a"}
+    b = {"role": "assistant", "content": "b"}
+    assert gm._dedupe_history([a, a, a, b, a]) == [
+        {"role": "user", "content": "a", "n": 3},
+        {"role": "assistant", "content": "b"},
+        {"role": "user", "content": "a"},
+    ]
+
+
+def test_collapse_history_keeps_tail_and_repeat_counts(game, gm) -> None:
+    """Older turns fold into one summary entry that keeps role labels and repeats."""
+    history = [{"role": "user", "content": "hello", "n": 3}, *_turns(game.VERBATIM_TURNS)]
+    collapsed = gm._collapse_history(history)
+    assert collapsed[0] == {"role": "summary", "content": "user (x3): hello"}
+    assert collapsed[1:] == history[1:]
+
+
+def test_save_at_verbatim_limit_is_not_collapsed(game, gm, tmp_path, monkeypatch) -> None:
+    history = _turns(game.VERBATIM_TURNS)
+    data = _save(game, gm, history, tmp_path, monkeypatch)
+    assert data["collapsed_turns"] == 0
+    assert data["turns_count"] == game.VERBATIM_TURNS
+    assert data["history"] == history
+
+
+def test_save_past_verbatim_limit_collapses_oldest(game, gm, tmp_path, monkeypatch) -> None:
+    history = _turns(game.VERBATIM_TURNS + 1)
+    data = _save(game, gm, history, tmp_path, monkeypatch)
+    assert data["collapsed_turns"] == 1
+    assert data["turns_count"] == game.VERBATIM_TURNS + 1
+    assert data["history"][0] == {"role": "summary", "content": "assistant: turn 0"}
+    assert data["history"][1:] == history[1:]
+
+
+def test_save_counts_raw_turns_with_duplicates(game, gm, tmp_path, monkeypatch) -> None:
+    history = [{"role": "user", "content": "my name is José, hi"}] * 2 + _turns(2)
+    data = _save(game, gm, history, tmp_path, monkeypatch)
+    assert data["player_name"] == "José"
+    assert data["turns_count"] == 4
+    assert data["history"][0] == {"role": "user", "content": "my name is José, hi", "n": 2}
+
+
+def test_save_reports_write_failure(game, gm, tmp_path, monkeypatch) -> None:
+    """A failed write reaches the player instead of a false success."""
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path / "missing"))
+    message = gm.save_game_state(_turns(2))
+    assert message.startswith("❌ Error saving game state:"), message
+
+
+def test_writer_resolves_future_with_job_result(game) -> None:
+    def failing_job() -> str:
+        raise RuntimeError("disk on fire")
+
+    assert game._queue_save(lambda: "done").result(timeout=5) == "done"
+    message = game._queue_save(failing_job).result(timeout=5)
+    assert message == "❌ Error saving game state: disk on fire"
+
+
+async def test_cancelled_restart_still_writes_save(game, tmp_path, monkeypatch) -> None:
+    """Barge-in cancels the tool call; the queued save must still land on disk."""
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path))
+    release = threading.Event()
+    game._queue_save(lambda: str(release.wait(timeout=5)))  # keep the writer busy
+
+    ctx = SimpleNamespace(session=_Session([_message("user", "hello")]))
+    task = asyncio.ensure_future(game.restart_tool(ctx))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    release.set()
+    await asyncio.to_thread(game._SAVE_Q.join)
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+
+def test_write_save_empty_metadata_and_history(game, tmp_path) -> None:
+    path = tmp_path / "empty.json"
+    game._write_save(str(path), {"history": []})
+    assert json.loads(path.read_text(encoding="utf-8")) == {"history": []}
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_write_save_round_trip(game, tmp_path) -> None:
+    save_data = {
+        "game": "The Whispering Library Escape",
+        "player_name": "Zoë",
+        "turns_count": 2,
+        "history": [
+            {"role": "user", "content": "Zoë"},
+            {"role": "assistant", "content": 'The door creaks, "ancient" and cold.'},
+        ],
+    }
+    path = tmp_path / "save.json"
+    game._write_save(str(path), save_data)
+    assert json.loads(path.read_text(encoding="utf-8")) == save_data
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_write_save_fsyncs_before_rename(game, tmp_path, monkeypatch) -> None:
+    calls = []
+    real_fsync, real_replace = os.fsync, os.replace
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append("fsync") or real_fsync(fd))
+    monkeypatch.setattr(os, "replace", lambda a, b: calls.append("replace") or real_replace(a, b))
+    game._write_save(str(tmp_path / "save.json"), {"history": _turns(1)})
+    assert calls == ["fsync", "replace"]
+
+
+async def test_restart_tool_saves_session_history(game, tmp_path, monkeypatch) -> None:
+    """The transcript comes from ctx.session.history; calls and non-text parts are dropped."""
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path))
+    items = [
+        _message("assistant", "Welcome to the library."),
+        _message("user", "my name is Bob", object()),
+        SimpleNamespace(type="function_call", name="restart_tool"),
+    ]
+    reply = await game.restart_tool(SimpleNamespace(session=_Session(items)))
+    assert reply.startswith("✅ Game state saved successfully as Bob_"), reply
+
+    (saved,) = tmp_path.glob("*.json")
+    data = json.loads(saved.read_text(encoding="utf-8"))
+    assert data["player_name"] == "Bob"
+    assert data["history"] == [
+        {"role": "assistant", "content": "Welcome to the library."},
+        {"role": "user", "content": "my name is Bob"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "ctx",
+    [SimpleNamespace(), SimpleNamespace(session=None), SimpleNamespace(session=_Session())],
+)
+async def test_restart_tool_without_history_skips_save(game, ctx, tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path))
+    assert await game.restart_tool(ctx) == game._NO_SAVE_MSG
+    await asyncio.to_thread(game._SAVE_Q.join)
+    assert not list(tmp_path.iterdir())
+
+
+async def test_restart_tool_reply_is_save_message_plus_restart(game, tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(game, "_SAVE_DIR_STR", str(tmp_path))
+    ctx = SimpleNamespace(session=_Session([_message("user", "Zoë")]))
+    reply = await game.restart_tool(ctx)
+    (saved,) = tmp_path.glob("*.json")
+    assert reply == f"✅ Game state saved successfully as {saved.name}. {game._RESTART_MSG}"
+    assert game.GM_LOGIC.restart_adventure() is game._RESTART_MSG
+    assert game._NO_SAVE_MSG == f"Could not save previous session. {game._RESTART_MSG}"